@@ -1,52 +1,187 @@
 # app.py
+import collections
+import functools
 import io
+import itertools
+import os
+import queue
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 import streamlit as st
 from PIL import Image, ImageDraw, ImageFont
-import qrcode
-import cv2
 import numpy as np
 
+try:
+    # Optional: libzbar is faster and more forgiving on photos than OpenCV's detector
+    from pyzbar.pyzbar import ZBarSymbol, decode as _zbar_decode
+except ImportError:
+    _zbar_decode = None
+
 # -----------------------
 # Helpers
 # -----------------------
-def read_qr_code(image: Image.Image):
-    img_array = np.array(image.convert("RGB"))
-    detector = cv2.QRCodeDetector()
-    data, bbox, _ = detector.detectAndDecode(img_array)
+# cv2 and segno are imported inside the functions that need them: "Generate & Split"
+# never loads OpenCV, and "Upload & Split" doesn't load segno until labels are built.
+
+@st.cache_resource(show_spinner=False)
+def _detector_pool():
+    # Outlives reruns; each detector is checked out by one caller at a time
+    return queue.SimpleQueue()
+
+def _detect_and_decode(img_array):
+    import cv2
+
+    pool = _detector_pool()
+    try:
+        detector = pool.get_nowait()
+    except queue.Empty:
+        detector = cv2.QRCodeDetector()
+    try:
+        data, _, _ = detector.detectAndDecode(img_array)
+    finally:
+        pool.put(detector)
+    return data
+
+# Uploads are shrunk to this longest side before detection; the detector is O(pixels)
+# and reads QR codes fine at this size
+MAX_DECODE_SIDE = 1024
+
+def _decode_grayscale(image_bytes: bytes):
+    import cv2
+
+    # The header gives the size without decoding pixels; big JPEGs are then decoded
+    # at 1/2, 1/4 or 1/8 scale by libjpeg itself instead of at full resolution
+    flag = cv2.IMREAD_GRAYSCALE
+    try:
+        longest = max(Image.open(io.BytesIO(image_bytes)).size)
+    except Exception:
+        longest = 0
+    reduced_flags = (
+        (8, cv2.IMREAD_REDUCED_GRAYSCALE_8),
+        (4, cv2.IMREAD_REDUCED_GRAYSCALE_4),
+        (2, cv2.IMREAD_REDUCED_GRAYSCALE_2),
+    )
+    for factor, reduced_flag in reduced_flags:
+        if longest // factor >= MAX_DECODE_SIDE:
+            flag = reduced_flag
+            break
+    return cv2.imdecode(np.frombuffer(image_bytes, np.uint8), flag)
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def read_qr_code(image_bytes: bytes):
+    import cv2
+
+    # The detector works on grayscale, so decode straight to one channel
+    img_array = _decode_grayscale(image_bytes)
+    if img_array is None:
+        return None
+    longest = max(img_array.shape)
+    if longest > MAX_DECODE_SIDE:
+        scale = MAX_DECODE_SIDE / longest
+        img_array = cv2.resize(img_array, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    if _zbar_decode is not None:
+        results = _zbar_decode(img_array, symbols=[ZBarSymbol.QRCODE])
+        if results:
+            # libzbar passes raw bytes through when its charset guess fails; leave those to OpenCV
+            try:
+                return results[0].data.decode("utf-8")
+            except UnicodeDecodeError:
+                pass
+    data = _detect_and_decode(img_array)
     return data if data else None
 
-def generate_split_qrs(base_text: str, count: int):
-    out = []
-    for i in range(1, count + 1):
-        data = f"{base_text}-{i}" if count > 1 else base_text
-        qr = qrcode.QRCode(
-            version=None,
-            error_correction=qrcode.constants.ERROR_CORRECT_M,
-            box_size=10,
-            border=2,
-        )
-        qr.add_data(data)
-        qr.make(fit=True)
-        img = qr.make_image(fill_color="black", back_color="white").convert("RGB")
-        out.append((data, img))
-    return out
+def _split_labels(base_text: str, count: int):
+    return [f"{base_text}-{i}" if count > 1 else base_text for i in range(1, count + 1)]
 
-def _load_font(size: int):
+@st.cache_data(show_spinner=False, max_entries=32)
+def generate_split_qrs(base_text: str, count: int, qr_size=None, border: int = 2, limit=None):
+    import segno
+
+    labels = _split_labels(base_text, count)
+    if not labels:
+        return []
+    # Every label fits the version of the longest one, and near-identical data scores
+    # near-identically per mask. Pinning both from one probe skips the per-label version
+    # search and the 8-way mask evaluation, which is where most encoding time goes.
+    # encoding="utf-8": segno's byte mode otherwise falls back to Shift_JIS for non-Latin-1
+    # text, which readers (and our own upload flow) decode as garbage
+    probe = segno.make_qr(max(labels, key=len), error="m", boost_error=False, encoding="utf-8")
+    encode = functools.partial(
+        segno.make_qr, error="m", version=probe.version, mask=probe.mask, boost_error=False,
+        encoding="utf-8",
+    )
+    # limit renders only the first labels (e.g. a preview) with the full batch's version and mask
+    labels = labels[:limit]
+    qrs = [encode(data) for data in labels]
+
+    # The pinned version gives every matrix the same shape, so the whole batch is
+    # rasterized as one (count, n, n) array instead of label by label
+    modules = np.array([qr.matrix for qr in qrs], dtype=np.uint8)  # 1 = dark
+    modules = np.pad(modules, ((0, 0), (border, border), (border, border)))
+    pixels = (1 - modules) * 255
+    if qr_size:
+        # Whole pixels per module, then pad with quiet zone up to exactly qr_size
+        box = max(1, qr_size // pixels.shape[1])
+        pixels = pixels.repeat(box, axis=1).repeat(box, axis=2)
+        pad = qr_size - pixels.shape[1]
+        if pad > 0:
+            edge = (pad // 2, pad - pad // 2)
+            pixels = np.pad(pixels, ((0, 0), edge, edge), constant_values=255)
+    return [(data, Image.fromarray(img)) for data, img in zip(labels, pixels)]
+
+@st.cache_resource(show_spinner=False)
+def _find_font_path():
     for name in ("DejaVuSans.ttf", "arial.ttf"):
         try:
-            return ImageFont.truetype(name, size)
+            return ImageFont.truetype(name, 10).path
         except Exception:
             continue
-    return ImageFont.load_default()
+    return None
+
+# Resolved once per process so loading a size doesn't re-probe the fallback chain
+_FONT_PATH = _find_font_path()
+
+# cache_resource rather than lru_cache: Streamlit re-executes this module on every
+# rerun, which would start an lru_cache empty each time
+@st.cache_resource(show_spinner=False, max_entries=128)
+def _load_font(size: int):
+    if _FONT_PATH is None:
+        return ImageFont.load_default()
+    return ImageFont.truetype(_FONT_PATH, size)
+
+def _text_size(text, font):
+    # Straight to the font: no ImageDraw needed, and textsize is gone in Pillow 10
+    left, top, right, bottom = font.getbbox(text)
+    return right - left, bottom - top
+
+def _scale_qr(qr_img, qr_size):
+    # Nearest-neighbour keeps module edges sharp
+    if qr_img.size == (qr_size, qr_size):
+        return qr_img
+    arr = np.asarray(qr_img if qr_img.mode == "L" else qr_img.convert("L"))
+    h, w = arr.shape
+    if qr_size % h == 0 and qr_size % w == 0:
+        arr = np.kron(arr, np.ones((qr_size // h, qr_size // w), dtype=np.uint8))
+    else:
+        import cv2
+
+        arr = cv2.resize(arr, (qr_size, qr_size), interpolation=cv2.INTER_NEAREST)
+    return Image.fromarray(arr)
 
-def _text_size(draw, text, font):
-    if hasattr(draw, "textbbox"):
-        left, top, right, bottom = draw.textbbox((0, 0), text, font=font)
-        return right - left, bottom - top
-    return draw.textsize(text, font=font)
+@dataclass(frozen=True)
+class LabelLayout:
+    label_w: int
+    label_h: int
+    dpi: int
+    qr_size: int
+    base_font_size: int
+    max_text_width: int
+    border_thickness_px: int
+    vertical_spacing_px: int
+    qr_shift_up_px: int
+    inner_margin_px: int
 
-def create_label_pages(
-    qr_images,
+def make_layout(
     label_width_in=1.0,
     label_height_in=2.5,
     dpi=300,
@@ -56,55 +191,127 @@ def create_label_pages(
     vertical_spacing_px=20,
     qr_shift_up_px=20,           # move QR up by 20px
     inner_margin_px=8
-):
-    LABEL_W = int(round(label_width_in * dpi))
-    LABEL_H = int(round(label_height_in * dpi))
-    qr_size = int(LABEL_W * qr_width_ratio)
-
-    pages = []
-    for label_text, qr_img in qr_images:
-        page = Image.new("RGB", (LABEL_W, LABEL_H), "white")
-        draw = ImageDraw.Draw(page)
-
-        # Border
-        for i in range(border_thickness_px):
-            draw.rectangle([i, i, LABEL_W - 1 - i, LABEL_H - 1 - i], outline="black")
-
-        # Resize QR
-        qr_resized = qr_img.resize((qr_size, qr_size))
-
-        # Font sizing
-        base_font_size = max(8, int(qr_size * text_scale))
-        font = _load_font(base_font_size)
-        max_text_width = LABEL_W - 2 * inner_margin_px
-        tw, th = _text_size(draw, label_text, font)
-        while (tw > max_text_width) and (base_font_size > 8):
-            base_font_size -= 1
-            font = _load_font(base_font_size)
-            tw, th = _text_size(draw, label_text, font)
-
-        # Position QR higher than centered
-        qr_x = (LABEL_W - qr_size) // 2
-        qr_y = max(inner_margin_px, (LABEL_H - qr_size - th - vertical_spacing_px) // 2 - qr_shift_up_px)
-        page.paste(qr_resized, (qr_x, qr_y))
-
-        # Position text under QR
-        text_x = (LABEL_W - tw) // 2
-        text_y = qr_y + qr_size + vertical_spacing_px
-        draw.text((text_x, text_y), label_text, font=font, fill="black")
-
-        pages.append(page)
-
-    return pages
+) -> LabelLayout:
+    label_w = int(round(label_width_in * dpi))
+    label_h = int(round(label_height_in * dpi))
+    qr_size = int(label_w * qr_width_ratio)
+    return LabelLayout(
+        label_w=label_w,
+        label_h=label_h,
+        dpi=dpi,
+        qr_size=qr_size,
+        base_font_size=max(8, int(qr_size * text_scale)),
+        max_text_width=label_w - 2 * inner_margin_px,
+        border_thickness_px=border_thickness_px,
+        vertical_spacing_px=vertical_spacing_px,
+        qr_shift_up_px=qr_shift_up_px,
+        inner_margin_px=inner_margin_px,
+    )
+
+def _render_label(template, label_text, qr_img, font, layout: LabelLayout):
+    qr_resized = _scale_qr(qr_img, layout.qr_size)
+    tw, th = _text_size(label_text, font)
+
+    # Position QR higher than centered
+    qr_x = (layout.label_w - layout.qr_size) // 2
+    qr_y = max(
+        layout.inner_margin_px,
+        (layout.label_h - layout.qr_size - th - layout.vertical_spacing_px) // 2 - layout.qr_shift_up_px,
+    )
+
+    # fromarray wraps the shared template without copying; Pillow makes the page's
+    # single private copy when ImageDraw first asks for a writable image
+    page = Image.fromarray(template)
+    draw = ImageDraw.Draw(page)
+    page.paste(qr_resized, (qr_x, qr_y))
+
+    # Position text under QR
+    text_x = (layout.label_w - tw) // 2
+    text_y = qr_y + layout.qr_size + layout.vertical_spacing_px
+    draw.text((text_x, text_y), label_text, font=font, fill=0)
+
+    return page
+
+@st.cache_resource(show_spinner=False, max_entries=16)
+def _label_template(label_w: int, label_h: int, border_thickness_px: int):
+    # Blank grayscale label + border, shared by every page of that geometry across
+    # reruns; read-only so a page can never draw into it
+    template = np.full((label_h, label_w), 255, dtype=np.uint8)
+    bt = border_thickness_px
+    if bt > 0:
+        template[:bt, :] = 0
+        template[-bt:, :] = 0
+        template[:, :bt] = 0
+        template[:, -bt:] = 0
+    template.flags.writeable = False
+    return template
+
+def iter_label_pages(qr_images, layout: LabelLayout, fit_text=None):
+    template = _label_template(layout.label_w, layout.label_h, layout.border_thickness_px)
+
+    # Font sizing: shrink once so the longest label fits, then share that font.
+    # fit_text lets a partial batch (the preview) size against the full batch's longest label.
+    font_size = layout.base_font_size
+    if fit_text is None:
+        fit_text = max((label_text for label_text, _ in qr_images), key=len, default="")
+    font = _load_font(font_size)
+    tw, _ = _text_size(fit_text, font)
+    while (tw > layout.max_text_width) and (font_size > 8):
+        font_size -= 1
+        font = _load_font(font_size)
+        tw, _ = _text_size(fit_text, font)
+
+    # A single label (count == 1) isn't worth spinning up a pool for
+    if len(qr_images) == 1:
+        label_text, qr_img = qr_images[0]
+        yield _render_label(template, label_text, qr_img, font, layout)
+        return
+
+    # Labels are independent; Pillow releases the GIL for most of the pixel work.
+    # Only a small window of labels is submitted ahead of the consumer, so the pool
+    # never holds more than that many finished pages. Note the PDF writer still keeps
+    # every page it is given until the whole document is encoded.
+    window = 2 * (os.cpu_count() or 1)
+    with ThreadPoolExecutor() as ex:
+        pending = collections.deque()
+        for label_text, qr_img in qr_images:
+            pending.append(ex.submit(_render_label, template, label_text, qr_img, font, layout))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
 
 def save_pages_to_pdf_bytes(pages, dpi=300) -> bytes:
-    if not pages:
+    # Labels are black on white; grayscale gives the PDF encoder a third of the bytes.
+    # Pillow collects every append_images page before it encodes anything.
+    gray_pages = (p if p.mode == "L" else p.convert("L") for p in pages)
+    first = next(gray_pages, None)
+    if first is None:
         return b""
+    second = next(gray_pages, None)
     buf = io.BytesIO()
-    pages[0].save(buf, format="PDF", save_all=True, append_images=pages[1:], resolution=float(dpi))
-    buf.seek(0)
+    if second is None:
+        first.save(buf, format="PDF", resolution=float(dpi))
+    else:
+        rest = itertools.chain([second], gray_pages)
+        first.save(buf, format="PDF", save_all=True, append_images=rest, resolution=float(dpi))
+    # getvalue() hands back BytesIO's own buffer without a copy, and its growth is
+    # already amortized, so a spooled temp file would only add work here
     return buf.getvalue()
 
+# The UI-facing entry points are keyed on the plain inputs, so a cache lookup
+# hashes a string and a few ints instead of every generated QR image
+@st.cache_data(show_spinner=False, max_entries=32)
+def build_labels_pdf(base_text: str, count: int, layout: LabelLayout) -> bytes:
+    qr_images = generate_split_qrs(base_text, count, layout.qr_size)
+    return save_pages_to_pdf_bytes(iter_label_pages(qr_images, layout), dpi=layout.dpi)
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def build_preview(base_text: str, count: int, layout: LabelLayout):
+    qr_images = generate_split_qrs(base_text, count, layout.qr_size, limit=1)
+    longest_text = max(_split_labels(base_text, count), key=len)
+    return next(iter_label_pages(qr_images, layout, fit_text=longest_text))
+
 # -----------------------
 # Streamlit UI
 # -----------------------
@@ -120,36 +327,36 @@ with st.expander("Advanced layout (optional)", expanded=False):
     vertical_spacing_px = st.slider("Spacing between QR and text (px)", 0, 60, 20, step=2)
     qr_shift_up_px = st.slider("Shift QR upward (px)", 0, 60, 20, step=2)
 
+layout = make_layout(
+    qr_width_ratio=qr_width_ratio,
+    text_scale=text_scale,
+    border_thickness_px=border_thickness_px,
+    vertical_spacing_px=vertical_spacing_px,
+    qr_shift_up_px=qr_shift_up_px,
+)
+
 count = st.number_input("Number of splits", min_value=1, value=3, step=1)
 
+def show_labels(base_text: str, count: int, layout: LabelLayout):
+    pdf_bytes = build_labels_pdf(base_text, count, layout)
+    st.download_button(
+        "📄 Download Labels PDF",
+        data=pdf_bytes,
+        file_name="qr_labels.pdf",
+        mime="application/pdf",
+    )
+    preview = build_preview(base_text, count, layout)
+    st.image(preview, caption="Preview: first label", use_column_width=False)
+
 if mode == "Upload & Split":
     uploaded = st.file_uploader("Upload a QR image (PNG/JPG)", type=["png", "jpg", "jpeg"])
     if uploaded:
-        pil_img = Image.open(uploaded)
-        base_text = read_qr_code(pil_img)
+        base_text = read_qr_code(uploaded.getvalue())
 
         if base_text:
             st.success(f"Decoded content: `{base_text}`")
             if st.button("Generate PDF"):
-                qr_images = generate_split_qrs(base_text, int(count))
-                pages = create_label_pages(
-                    qr_images,
-                    qr_width_ratio=qr_width_ratio,
-                    text_scale=text_scale,
-                    border_thickness_px=border_thickness_px,
-                    vertical_spacing_px=vertical_spacing_px,
-                    qr_shift_up_px=qr_shift_up_px,
-                )
-                pdf_bytes = save_pages_to_pdf_bytes(pages, dpi=300)
-
-                st.download_button(
-                    "📄 Download Labels PDF",
-                    data=pdf_bytes,
-                    file_name="qr_labels.pdf",
-                    mime="application/pdf",
-                )
-                if pages:
-                    st.image(pages[0], caption="Preview: first label", use_column_width=False)
+                show_labels(base_text, int(count), layout)
         else:
             st.error("Could not read a QR code from the uploaded image.")
 
@@ -159,26 +366,4 @@ else:
         if not text_input.strip():
             st.error("Please enter some text.")
         else:
-            qr_images = generate_split_qrs(text_input.strip(), int(count))
-            pages = create_label_pages(
-                qr_images,
-                qr_width_ratio=qr_width_ratio,
-                text_scale=text_scale,
-                border_thickness_px=border_thickness_px,
-                vertical_spacing_px=vertical_spacing_px,
-                qr_shift_up_px=qr_shift_up_px,
-            )
-            pdf_bytes = save_pages_to_pdf_bytes(pages, dpi=300)
-
-            st.download_button(
-                "📄 Download Labels PDF",
-                data=pdf_bytes,
-                file_name="qr_labels.pdf",
-                mime="application/pdf",
-            )
-            if pages:
-                st.image(pages[0], caption="Preview: first label", use_column_width=False)
-
-
-
-
+            show_labels(text_input.strip(), int(count), layout)